@@ -1,9 +1,14 @@
+from time import perf_counter, sleep
+
 import pybullet as bullet
 from liba1 import A1
 
 # Initialisation
 physics_server_id = bullet.connect(bullet.GUI)
-bullet.setRealTimeSimulation(enableRealTimeSimulation=True, physicsClientId=physics_server_id)
+# The simulation is stepped explicitly at a fixed time step, DT, rather than in real time by the physics server
+DT = 1 / 240
+bullet.setRealTimeSimulation(enableRealTimeSimulation=False, physicsClientId=physics_server_id)
+bullet.setTimeStep(DT, physics_server_id)
 bullet.setGravity(0, 0, -9.8, physics_server_id)
 import pybullet_data; bullet.setAdditionalSearchPath(pybullet_data.getDataPath());
 bullet.loadURDF("plane.urdf")
@@ -15,21 +20,24 @@ bullet.resetDebugVisualizerCamera(
     cameraYaw = 40,
     cameraPitch = -15)
 
-debug_motors = a1.motor_info().applymap(
-    lambda info: (index := info[0], bullet.addUserDebugParameter(
+debug_motors = [
+    (index := info[0], bullet.addUserDebugParameter(
                                         physicsClientId = physics_server_id,
                                         paramName = info[1].decode("UTF-8"),
                                         rangeMin = info[8],
                                         rangeMax = info[9],
-                                        startValue = 0.7 if index in a1.motor_indices.loc[A1.Motor.h_fe.value, :].to_numpy()    # FIXME: Use 3.11 enum.StrEnum to remove .value
-                                               else -0.7*2 if index in a1.motor_indices.loc[A1.Motor.knee.value, :].to_numpy()  # FIXME: Use 3.11 enum.StrEnum to remove .value
+                                        startValue = 0.7 if index in a1.motor_indices[A1.motor_row[A1.Motor.h_fe]]
+                                               else -0.7*2 if index in a1.motor_indices[A1.motor_row[A1.Motor.knee]]
                                                else  0,))
-).to_numpy().flatten()
+    for info in a1.motor_info()]
 
 while True:
+    start = perf_counter()
     bullet.setJointMotorControlArray(
         physicsClientId = physics_server_id,
         bodyUniqueId = a1.id,
         jointIndices = [index for index, _ in debug_motors],
         controlMode = bullet.POSITION_CONTROL,
         targetPositions = [bullet.readUserDebugParameter(param) for _, param in debug_motors],)
+    bullet.stepSimulation(physics_server_id)
+    sleep(max(0, DT - (perf_counter() - start)))
@@ -1,17 +1,17 @@
 import pybullet as bullet
-import pandas as pd
 import numpy as np
 import logging
 from enum import Enum
+from math import sin, cos, sqrt, atan2, acos, fabs, nan
 from typing import Iterable
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(funcName)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    # filename='liba1.log',
-    # filemode='w',
-    encoding='utf-8')
+try:
+    from numba import njit
+except ImportError:  # Numba is optional; without it the kinematics kernels run as plain Python
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+logger = logging.getLogger(__name__)
 
 class A1:
 
@@ -31,12 +31,21 @@ class A1:
         h_fe = 'hip flexion/extension'
         knee = 'knee'
 
-    motor_indices = pd.DataFrame(dtype=np.int8, index = Motor.list(), columns = Leg.list(),
+    motor_indices = np.array(dtype=np.int32, object=[
                         # front-right, front-left, hind-right, hind-left
-        data = np.array([[     1     ,      6    ,     11    ,     16   ],    # hip abduction/adduction
-                         [     3     ,      8    ,     13    ,     18   ],    # hip flexion/extension
-                         [     4     ,      9    ,     14    ,     19   ]]))  # knee
+                        [      1     ,      6    ,     11    ,     16   ],    # hip abduction/adduction
+                        [      3     ,      8    ,     13    ,     18   ],    # hip flexion/extension
+                        [      4     ,      9    ,     14    ,     19   ]])   # knee
+    motor_row = {motor: row for row, motor in enumerate(Motor)}  # row of each Motor in motor_indices
+    leg_joints = tuple(map(tuple, motor_indices.T.tolist()))  # joint indices of each leg, ((1, 3, 4), (6, 8, 9), ...)
+    all_joints = sum(leg_joints, ())  # joint indices of all legs, leg after leg, matching a flattened posture
+    # In the order of Leg
+    side_mask = np.array([0, 1, 0, 1], dtype=np.int8)  # 0 for a right leg, 1 for a left leg
+    l_sign    = np.array([1., 1., -1., -1.])  # sign of the hip's x relative to the body centre
+    w_sign    = np.array([1., -1., 1., -1.])  # sign of the hip's y relative to the body centre
     # Obtained by measuring the STL file of the thigh and calf. Both are 0.2mm.
+    # The kinematics are compiled with these values at import time, so they are fixed; overriding them in a subclass
+    # has no effect on solve_posture() and the kinematics.
     thigh_len  = 200
     shank_len  = 200
     hip_offset = 80   # TODO: Obtain more accurate value
@@ -58,41 +67,35 @@ class A1:
             physicsClientId = self.in_physics_client,
             flags = bullet.URDF_USE_SELF_COLLISION,
             useFixedBase = False)
+        self._posture = np.empty((4, 3))  # motor targets solved by postural_control()
+        self._ctrl_cache = (None, None, None)  # inputs, reference and motor targets of the last postural_control()
         # Set initial postion of motors.
         bullet.setJointMotorControlArray(
             physicsClientId = self.in_physics_client,
             bodyUniqueId = self.id,
-            jointIndices = self.motor_indices.loc[A1.Motor.h_aa.value, :],  # TODO: Use 3.11 enum.StrEnum to remove .value
+            jointIndices = self.motor_indices.flatten().tolist(),  # all h_aa, then all h_fe, then all knee motors
             controlMode = bullet.POSITION_CONTROL,
-            targetPositions = np.full(4, 0),)
-        bullet.setJointMotorControlArray(
-            physicsClientId = self.in_physics_client,
-            bodyUniqueId = self.id,
-            jointIndices = self.motor_indices.loc[A1.Motor.h_fe.value, :],  # TODO: Use 3.11 enum.StrEnum to remove .value
-            controlMode = bullet.POSITION_CONTROL,
-            targetPositions = np.full(4, 0.7),)
-        bullet.setJointMotorControlArray(
-            physicsClientId = self.in_physics_client,
-            bodyUniqueId = self.id,
-            jointIndices = self.motor_indices.loc[A1.Motor.knee.value, :],  # TODO: Use 3.11 enum.StrEnum to remove .value
-            controlMode = bullet.POSITION_CONTROL,
-            targetPositions = np.full(4, -0.7*2),)  # ensures that the toes are beneath the hips
+            targetPositions = [0.] * 4 + [0.7] * 4 + [-0.7*2] * 4,)  # -0.7*2 ensures that the toes are beneath the hips
 
 
     def motor_info(self):
         """
-        A matrix contains motor information. The info is structured as
+        A list of motor information, three motors of a leg after another in the order of Leg. The info is structured as
         Tuple(jointIndex, jointName, jointType, qIndex, uIndex, flags, jointDamping,
         jointFriction, jointLowerLimit, jointUpperLimit, jointMaxForce, jointMaxVelocity,
         linkName, jointAxis, parentFramePos, parentFrameOrn, parentIndex)
 
         See PyBullet document for getJointInfo().
         """
-        return A1.motor_indices.applymap(lambda index: bullet.getJointInfo(self.id, index))
+        return [bullet.getJointInfo(self.id, index, self.in_physics_client) for index in A1.all_joints]
 
 
     def current_posture(self):
-        return A1.motor_indices.applymap(lambda index: bullet.getJointState(self.id, index, self.in_physics_client)[0])
+        """
+        A (4, 3) array of motor angular positions, a row of three motors per leg in the order of Leg
+        """
+        states = bullet.getJointStates(self.id, A1.all_joints, self.in_physics_client)
+        return np.array([state[0] for state in states]).reshape(4, 3)
 
 
     def postural_control(self, yaw_angle=0., pitch_angle=0., roll_angle=0., Δz=0., reference_posture=None) -> None:
@@ -101,151 +104,210 @@ class A1:
             Height is not easily defined for a legged robot on uneven terrains; hence, z-coordinate of the toe
             relative to the coordinate system on the hip of each leg is used.
         :param reference_posture:
-            A frame of reference which the attitude and position given by the other params is relative to
+            A frame of reference which the attitude and position given by the other params is relative to.
+            It is identified by object, so it must not be modified in place between calls.
+            If None, the current posture is the reference. Repeating a call with the same inputs keeps the motor
+            targets of the first call rather than moving the robot again relative to where it is now.
         """
 
-        if reference_posture is None:
-            # FIXME: Taking an angle of 0.0 and calculating it repeatedly with respect to the current posture,
-            # it can be observed that the errors add up and the posture of the robot is slowly distorted.
-            # Possible solution: decrease to 3 decimal places.
-            posture = self.current_posture()
-        else:
-            posture = reference_posture.copy()
-
-        for leg, θ in posture.items():  #! Pass by reference; modify θ will also modify the element in posture
-            # θ is a tuple of three motor angular positions of one leg
-
-            # Abbreviating to increase readability
-            α = yaw_angle
-            β = pitch_angle
-            γ = roll_angle
-            L = A1.body_len / 2
-            W = A1.body_width / 2
-
-            x, y, z = A1._forward_kinematics(leg, *θ)
-
-            # Adjust height
-            z -= Δz  # FIXME: Wrong algrithm.
-
-            # x, y, z after rolling
-            match leg:
-                case A1.Leg.fr.value | A1.Leg.hr.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    roll = np.array([[ 1,  0,          0,          0                 ],
-                                     [ 0,  np.cos(γ), -np.sin(γ),  W * np.cos(γ) - W ],
-                                     [ 0,  np.sin(γ),  np.cos(γ),  W * np.sin(γ)     ],
-                                     [ 0,  0,          0,          1                 ]])
-                case A1.Leg.fl.value | A1.Leg.hl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    roll = np.array([[ 1,  0,          0,          0                 ],
-                                     [ 0,  np.cos(γ), -np.sin(γ), -W * np.cos(γ) + W ],
-                                     [ 0,  np.sin(γ),  np.cos(γ), -W * np.sin(γ)     ],
-                                     [ 0,  0,          0,          1                 ]])
-            x, y, z, _ = roll.dot(np.array([x, y, z, 1]))
-
-            # x, z after pitching
-            match leg:
-                case A1.Leg.fr.value | A1.Leg.fl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    pitch = np.array([[ np.cos(β), -np.sin(β),  L * np.cos(β) - L ],
-                                      [ np.sin(β),  np.cos(β),  L * np.sin(β)     ],
-                                      [ 0,          0,          1                 ]])
-                case A1.Leg.hr.value | A1.Leg.hl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    pitch = np.array([[ np.cos(β), -np.sin(β), -L * np.cos(β) + L ],
-                                      [ np.sin(β),  np.cos(β), -L * np.sin(β)     ],
-                                      [ 0,          0,          1                 ]])
-            x, z, _ = pitch.dot(np.array([x, z, 1]))
-
-            # x, y, z after yawing
-            match leg:
-                case A1.Leg.fr.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    yaw = np.array([[ np.cos(α), -np.sin(α),   0,   L * np.cos(α) - W * np.sin(α) - L ],
-                                    [ np.sin(α),  np.cos(α),   0,   L * np.sin(α) + W * np.cos(α) - W ],
-                                    [ 0,          0,           1,   0                                 ],
-                                    [ 0,          0,           0,   1                                 ]])
-                case A1.Leg.fl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    yaw = np.array([[ np.cos(α), -np.sin(α),   0,   L * np.cos(α) + W * np.sin(α) - L ],
-                                    [ np.sin(α),  np.cos(α),   0,   L * np.sin(α) - W * np.cos(α) + W ],
-                                    [ 0,          0,           1,   0                                 ],
-                                    [ 0,          0,           0,   1                                 ]])
-                case A1.Leg.hr.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    yaw = np.array([[ np.cos(α), -np.sin(α),   0,  -L * np.cos(α) - W * np.sin(α) + L ],
-                                    [ np.sin(α),  np.cos(α),   0,  -L * np.sin(α) + W * np.cos(α) - W ],
-                                    [ 0,          0,           1,   0                                 ],
-                                    [ 0,          0,           0,   1                                 ]])
-                case A1.Leg.hl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                    yaw = np.array([[ np.cos(α), -np.sin(α),   0,  -L * np.cos(α) + W * np.sin(α) + L ],
-                                    [ np.sin(α),  np.cos(α),   0,  -L * np.sin(α) - W * np.cos(α) + W ],
-                                    [ 0,          0,           1,   0                                 ],
-                                    [ 0,          0,           0,   1                                 ]])
-            x, y, z, _ = yaw.dot(np.array([x, y, z, 1]))
-
-            θ[0], θ[1], θ[2] = A1._inverse_kinematics(leg, x, y, z)
-
-            # If θ[0] or θ[1] or θ[2] exceeds its limits, aborting the method
-            if not all([-0.803<θ[0]<0.803, -1.047<θ[1]<4.189, -2.697<θ[2]<-0.916]):
-                logging.info('Motor limit reached')
+        # The targets are only recomputed when the inputs change; the same inputs give the same targets.
+        key = (round(yaw_angle, 4), round(pitch_angle, 4), round(roll_angle, 4), round(Δz, 4))
+        if key != self._ctrl_cache[0] or reference_posture is not self._ctrl_cache[1]:
+            self._ctrl_cache = (None, None, None)  # self._posture is overwritten below
+            if reference_posture is None:
+                # FIXME: Taking an angle of 0.0 and calculating it repeatedly with respect to the current posture,
+                # it can be observed that the errors add up and the posture of the robot is slowly distorted.
+                # Possible solution: decrease to 3 decimal places.
+                # The cache above stops this while the inputs are unchanged, but not while they are changing.
+                self._posture[:] = self.current_posture()
+            else:
+                self._posture[:] = reference_posture
+
+            if not A1.solve_posture(self._posture, yaw_angle, pitch_angle, roll_angle, Δz):
+                logger.info('Motor limit reached')
                 return
+            # The reference itself is kept, rather than its id(), which may be reused once the object is freed
+            self._ctrl_cache = (key, reference_posture, self._posture)
+        self.set_posture(self._ctrl_cache[2])
+
+
+    def set_posture(self, posture) -> None:
+        """
+        :param posture: a (4, 3) array of motor angular positions, a row per leg, sent to the motors as their targets
+        """
 
         # Control angular position of each motor
-        for positions_of_one_leg, indices_of_one_leg in zip(posture.itertuples(index=False), A1.motor_indices.itertuples(index=False)):
-            bullet.setJointMotorControlArray(
-                physicsClientId = self.in_physics_client,
-                bodyUniqueId = self.id,
-                controlMode = bullet.POSITION_CONTROL,
-                jointIndices = indices_of_one_leg,
-                targetPositions = positions_of_one_leg,)
+        bullet.setJointMotorControlArray(
+            physicsClientId = self.in_physics_client,
+            bodyUniqueId = self.id,
+            controlMode = bullet.POSITION_CONTROL,
+            jointIndices = A1.all_joints,
+            targetPositions = posture.ravel().tolist(),)
 
 
-    @classmethod
-    def _forward_kinematics(cls, leg: Leg, θ0, θ1, θ2):
+    @staticmethod
+    def solve_posture(posture, yaw_angle, pitch_angle, roll_angle, Δz) -> bool:
         """
-        θ0, θ1, θ2 ⇒ x, y, z
+        Moves a posture by the given attitude and height. It needs no physics client, so it can run in another process.
 
-        :param θ0: angular position of hip abd/add motor
-        :param θ1: angular position of hip fle/ext motor
-        :param θ2: angular position of knee motor
-        :return  : a tuple, (x, y, z), which is coordinates of the toe relative to the hip
+        :param posture: a (4, 3) array of motor angular positions, a row per leg; updated in place
+        :return       : False if any motor exceeds its limits, in which case the posture is partly updated
         """
 
-        # Abbreviating to increase readability
-        l1 = cls.thigh_len
-        l2 = cls.shank_len
-        o  = cls.hip_offset
-        h  =  l1 * np.cos(θ1) + l2 * np.cos(θ1 + θ2)  # distance from the toe to the top centre of the thigh rod
+        attitude = (sin(yaw_angle), cos(yaw_angle), sin(pitch_angle), cos(pitch_angle), sin(roll_angle), cos(roll_angle))
+        return _postural_kernel(A1.side_mask, A1.l_sign, A1.w_sign, posture, attitude, Δz)
+
+
+    @staticmethod
+    def _forward_kinematics(side: int, θ0, θ1, θ2):
+        """
+        θ0, θ1, θ2 ⇒ x, y, z
 
-        x = -l1 * np.sin(θ1) - l2 * np.sin(θ1 + θ2)
-        match leg:
-            case A1.Leg.fr.value | A1.Leg.hr.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                y =  o * np.cos(θ0) - h * np.sin(θ0)
-                z = -o * np.sin(θ0) - h * np.cos(θ0)
-            case A1.Leg.fl.value | A1.Leg.hl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                y = -o * np.cos(θ0) - h * np.sin(θ0)
-                z =  o * np.sin(θ0) - h * np.cos(θ0)
+        :param side: 0 for a right leg, 1 for a left leg
+        :param θ0  : angular position of hip abd/add motor
+        :param θ1  : angular position of hip fle/ext motor
+        :param θ2  : angular position of knee motor
+        :return    : a tuple, (x, y, z), which is coordinates of the toe relative to the hip
+        """
 
-        return (x, y, z)
+        return _fk(side, θ0, θ1, θ2)
 
 
-    @classmethod
-    def _inverse_kinematics(cls, leg: Leg, x, y, z):
+    @staticmethod
+    def _inverse_kinematics(side: int, x, y, z):
         """
         x, y, z ⇒ θ0, θ1, θ2
 
+        :param side   : 0 for a right leg, 1 for a left leg
         :param x, y, z: coordinates of the toe relative to the hip
         :return       : a tuple, (θ0, θ1, θ2), which is angular position of three motors on a leg
         """
 
-        # Abbreviating to increase readability
-        l1 = cls.thigh_len
-        l2 = cls.shank_len
-        o  = cls.hip_offset
-        h  = np.sqrt(z**2 + y**2 - o**2)
-
-        cosθ2 = (-l1**2 - l2**2 + x**2 + h**2) / (2 * l1 * l2)
-        sinθ2 = -np.sqrt(1 - cosθ2**2)  # takes negative suqare root, because the knee's position is specified as negative
-        match leg:
-            case A1.Leg.fr.value | A1.Leg.hr.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                θ0 = np.arctan2(np.abs(z), y) - np.arctan2(h, o)
-            case A1.Leg.fl.value | A1.Leg.hl.value:  # TODO: Use 3.11 enum.StrEnum to remove .value
-                θ0 = np.arctan2(h, o) - np.arctan2(np.abs(z), -y)
-        θ1 = np.arccos((l1**2 + x**2 + h**2 - l2**2) / (2 * l1 * np.sqrt(x**2 + h**2))) - np.arctan2(x, h)
-        θ2 = np.arctan2(sinθ2, cosθ2)
-
-        return (θ0, θ1, θ2)
+        return _ik(side, x, y, z)
+
+
+# All fast-math flags but 'nnan' and 'ninf'. An unreachable toe position yields NaN joint angles, and the motor
+# limit check relies on NaN comparing false.
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+# The kernels below are specialised to the geometry of A1: Numba freezes global variables into the machine code as
+# compile-time constants, so these lengths are folded into the arithmetic. Changing them in A1 changes this file,
+# which invalidates Numba's on-disk cache.
+_l1 = A1.thigh_len
+_l2 = A1.shank_len
+_o  = A1.hip_offset
+_L  = A1.body_len / 2
+_W  = A1.body_width / 2
+
+
+@njit(cache=True, fastmath=_FASTMATH)
+def _fk(side, θ0, θ1, θ2):
+    """
+    Scalar kernel of A1._forward_kinematics()
+
+    :param side: 0 for a right leg, 1 for a left leg
+    """
+
+    # Abbreviating to increase readability
+    l1, l2, o = _l1, _l2, _o
+    h =  l1 * cos(θ1) + l2 * cos(θ1 + θ2)  # distance from the toe to the top centre of the thigh rod
+
+    x = -l1 * sin(θ1) - l2 * sin(θ1 + θ2)
+    if side == 0:
+        y =  o * cos(θ0) - h * sin(θ0)
+        z = -o * sin(θ0) - h * cos(θ0)
+    else:
+        y = -o * cos(θ0) - h * sin(θ0)
+        z =  o * sin(θ0) - h * cos(θ0)
+
+    return (x, y, z)
+
+
+@njit(cache=True, fastmath=_FASTMATH)
+def _ik(side, x, y, z):
+    """
+    Scalar kernel of A1._inverse_kinematics()
+
+    :param side: 0 for a right leg, 1 for a left leg
+    :return    : (nan, nan, nan) if the toe is out of reach
+    """
+
+    # Abbreviating to increase readability
+    l1, l2, o = _l1, _l2, _o
+    h_sq = z * z + y * y - o * o
+    if h_sq < 0:
+        return (nan, nan, nan)
+    h  = sqrt(h_sq)
+    r_sq  = x * x + h_sq  # squared distance from the toe to the hip fle/ext motor
+    if r_sq == 0:  # the toe is on the hip fle/ext axis, so θ1 is undefined
+        return (nan, nan, nan)
+    l1_sq = l1 * l1
+    l2_sq = l2 * l2
+
+    cosθ2 = (-l1_sq - l2_sq + r_sq) / (2 * l1 * l2)
+    if not -1 <= cosθ2 <= 1:
+        return (nan, nan, nan)
+    sinθ2 = -sqrt(1 - cosθ2 * cosθ2)  # takes negative suqare root, because the knee's position is specified as negative
+    if side == 0:
+        θ0 = atan2(fabs(z), y) - atan2(h, o)
+    else:
+        θ0 = atan2(h, o) - atan2(fabs(z), -y)
+    θ1 = acos((l1_sq + r_sq - l2_sq) / (2 * l1 * sqrt(r_sq))) - atan2(x, h)
+    θ2 = atan2(sinθ2, cosθ2)
+
+    return (θ0, θ1, θ2)
+
+
+@njit(cache=True, fastmath=_FASTMATH)
+def _postural_kernel(sides, l_signs, w_signs, posture, attitude, Δz):
+    """
+    FK, height adjustment, yaw · pitch · roll and IK of all legs in one call
+
+    :param sides   : side of each leg, 0 for right and 1 for left
+    :param l_signs : sign of the x of each hip relative to the body centre
+    :param w_signs : sign of the y of each hip relative to the body centre
+    :param posture : (4, 3) array of motor angular positions, a row per leg; updated in place
+    :param attitude: sines and cosines of the yaw, pitch and roll angles, (sα, cα, sβ, cβ, sγ, cγ)
+    :return        : False as soon as a motor exceeds its limits, leaving the remaining legs unsolved
+    """
+
+    # Abbreviating to increase readability
+    sα, cα, sβ, cβ, sγ, cγ = attitude
+    L, W = _L, _W
+
+    # Rolling, pitching and yawing (see README.md) are fused into one affine transformation, yaw · pitch · roll.
+    # Its rotation part is the same for all legs.
+    r00, r01, r02 = cα * cβ, -cα * sβ * sγ - sα * cγ, -cα * sβ * cγ + sα * sγ
+    r10, r11, r12 = sα * cβ, -sα * sβ * sγ + cα * cγ, -sα * sβ * cγ - cα * sγ
+    r20, r21, r22 = sβ,       cβ * sγ,                 cβ * cγ
+
+    for i in range(posture.shape[0]):
+        sL = l_signs[i]
+        sW = w_signs[i]
+
+        # Translation part of yaw · pitch · roll
+        tx_pitch = sL * L * (cβ - 1) - sβ * sW * W * sγ  # x translation after rolling and pitching
+        ty_roll  = sW * W * (cγ - 1)                      # y translation after rolling
+        tx = cα * tx_pitch - sα * ty_roll + sL * L * (cα - 1) - sW * W * sα
+        ty = sα * tx_pitch + cα * ty_roll + sL * L * sα + sW * W * (cα - 1)
+        tz = cβ * sW * W * sγ + sL * L * sβ
+
+        x, y, z = _fk(sides[i], posture[i, 0], posture[i, 1], posture[i, 2])
+
+        # Adjust height
+        z -= Δz  # FIXME: Wrong algrithm.
+
+        # x, y, z after rolling, pitching and yawing
+        x, y, z = (r00 * x + r01 * y + r02 * z + tx,
+                   r10 * x + r11 * y + r12 * z + ty,
+                   r20 * x + r21 * y + r22 * z + tz)
+
+        θ0, θ1, θ2 = _ik(sides[i], x, y, z)
+
+        # If θ0 or θ1 or θ2 exceeds its limits, aborting
+        if not (-0.803 < θ0 < 0.803 and -1.047 < θ1 < 4.189 and -2.697 < θ2 < -0.916):
+            return False
+        posture[i, 0], posture[i, 1], posture[i, 2] = θ0, θ1, θ2
+
+    return True
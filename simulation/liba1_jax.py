@@ -0,0 +1,67 @@
+"""
+JAX version of the kinematics of A1, vectorised over the legs with jax.vmap and compiled with jax.jit.
+
+Unlike liba1, it solves any number of postures in one call and is differentiable, e.g. jax.jacfwd gives the Jacobian
+of FK. liba1 stays the implementation used by the simulation; this module needs the optional 'jax' extra.
+
+JAX computes in float32 unless jax_enable_x64 is set by the application.
+"""
+
+import jax
+import jax.numpy as jnp
+from liba1 import A1
+
+# Abbreviating to increase readability
+l1 = A1.thigh_len
+l2 = A1.shank_len
+o  = A1.hip_offset
+
+
+def _fk(side, θ):
+    """
+    θ0, θ1, θ2 ⇒ x, y, z of one leg; see A1._forward_kinematics()
+
+    :param side: 0 for a right leg, 1 for a left leg
+    :param θ   : (3,) angular positions of the hip abd/add, hip fle/ext and knee motors
+    """
+
+    θ0, θ1, θ2 = θ
+    h =  l1 * jnp.cos(θ1) + l2 * jnp.cos(θ1 + θ2)  # distance from the toe to the top centre of the thigh rod
+
+    x = -l1 * jnp.sin(θ1) - l2 * jnp.sin(θ1 + θ2)
+    y = jnp.where(side == 0, o * jnp.cos(θ0), -o * jnp.cos(θ0)) - h * jnp.sin(θ0)
+    z = jnp.where(side == 0, -o * jnp.sin(θ0), o * jnp.sin(θ0)) - h * jnp.cos(θ0)
+
+    return jnp.stack([x, y, z])
+
+
+def _ik(side, toe):
+    """
+    x, y, z ⇒ θ0, θ1, θ2 of one leg; see A1._inverse_kinematics(). An unreachable toe position gives NaN.
+
+    :param side: 0 for a right leg, 1 for a left leg
+    :param toe : (3,) coordinates of the toe relative to the hip
+    """
+
+    x, y, z = toe
+    h_sq = z * z + y * y - o * o
+    h    = jnp.sqrt(h_sq)
+    r_sq = x * x + h_sq  # squared distance from the toe to the hip fle/ext motor
+
+    cosθ2 = (-l1 * l1 - l2 * l2 + r_sq) / (2 * l1 * l2)
+    sinθ2 = -jnp.sqrt(1 - cosθ2 * cosθ2)  # takes negative suqare root, because the knee's position is specified as negative
+    θ0 = jnp.where(side == 0,
+                   jnp.arctan2(jnp.abs(z), y) - jnp.arctan2(h, o),
+                   jnp.arctan2(h, o) - jnp.arctan2(jnp.abs(z), -y))
+    θ1 = jnp.arccos((l1 * l1 + r_sq - l2 * l2) / (2 * l1 * jnp.sqrt(r_sq))) - jnp.arctan2(x, h)
+    θ2 = jnp.arctan2(sinθ2, cosθ2)
+
+    return jnp.stack([θ0, θ1, θ2])
+
+
+# Each takes the sides, e.g. A1.side_mask, and a (4, 3) array with a row per leg. Add a leading axis of postures with
+# jax.vmap(..., in_axes=(None, 0)).
+forward_kinematics  = jax.jit(jax.vmap(_fk))
+inverse_kinematics  = jax.jit(jax.vmap(_ik))
+# (4, 3, 3) Jacobians of the toe coordinates with respect to the motor angular positions
+forward_kinematics_jacobian = jax.jit(jax.vmap(jax.jacfwd(_fk, argnums=1)))
@@ -1,112 +1,194 @@
-from time import sleep
-
-import pybullet as bullet
-from liba1 import A1
-
-# Initialisation
-physics_server_id = bullet.connect(bullet.GUI)
-bullet.setRealTimeSimulation(enableRealTimeSimulation=True, physicsClientId=physics_server_id)
-bullet.setGravity(0, 0, -30, physics_server_id)
-import pybullet_data; bullet.setAdditionalSearchPath(pybullet_data.getDataPath())
-bullet.loadURDF("plane.urdf", physicsClientId=physics_server_id)
-a1 = A1(physics_server_id)
-bullet.resetDebugVisualizerCamera(
-    physicsClientId = physics_server_id,
-    cameraTargetPosition = [0, 0, 0.4],
-    cameraDistance = 1.5,
-    cameraYaw = 40,
-    cameraPitch = -15)
-
-# Debug parameter silders to adjust the robot's motions
-debug_roll_angle = bullet.addUserDebugParameter(
-    paramName = "roll angle (rad)",
-    rangeMin = -0.5,
-    rangeMax =  0.5,
-    startValue = 0,)
-debug_pitch_angle = bullet.addUserDebugParameter(
-    paramName = "pitch angle (rad)",
-    rangeMin = -0.31,
-    rangeMax =  0.31,
-    startValue = 0,)
-debug_yaw_angle = bullet.addUserDebugParameter(
-    paramName = "yaw angle (rad)",
-    rangeMin = -0.36,
-    rangeMax =  0.36,
-    startValue = 0,)
-debug_height = bullet.addUserDebugParameter(
-    paramName = "Delta z",
-    rangeMin = -200,
-    rangeMax = 60,
-    startValue = 0,)
-
-# Buttons to change the observing views
-debug_initial_view = bullet.addUserDebugParameter(
-    paramName="initial view",
-    rangeMin = 1,
-    rangeMax = 0,
-    startValue = 0)
-initial_view = bullet.readUserDebugParameter(debug_initial_view)
-debug_front_view = bullet.addUserDebugParameter(
-    paramName="front view",
-    rangeMin = 1,
-    rangeMax = 0,
-    startValue = 0)
-front_view = bullet.readUserDebugParameter(debug_front_view)
-debug_top_view = bullet.addUserDebugParameter(
-    paramName="top view",
-    rangeMin = 1,
-    rangeMax = 0,
-    startValue = 0)
-top_view = bullet.readUserDebugParameter(debug_top_view)
-
-# Button to reset the robot position
-reset = bullet.addUserDebugParameter(
-    paramName="Reset Position",
-    rangeMin = 1,
-    rangeMax = 0,
-    startValue = 0)
-reset_value  = bullet.readUserDebugParameter(reset)
-
-sleep(1)  # Ugly so FIXME
-# The initialisation is asynchronous. Wait one second to ensure that the motors reach their initial position before reading the position values.
-ini_posture = a1.current_posture()
-while True:
-    a1.postural_control(
-        yaw_angle   = bullet.readUserDebugParameter(debug_yaw_angle),
-        pitch_angle = bullet.readUserDebugParameter(debug_pitch_angle),
-        roll_angle  = bullet.readUserDebugParameter(debug_roll_angle),
-        Δz          = bullet.readUserDebugParameter(debug_height),
-        reference_posture=ini_posture)
-
-    if bullet.readUserDebugParameter(debug_initial_view) != initial_view:
-        # set the camera to be initial view
-        bullet.resetDebugVisualizerCamera(
-            physicsClientId = physics_server_id,
-            cameraTargetPosition = [0, 0, 0.4],
-            cameraDistance = 1.5,
-            cameraYaw = 40,
-            cameraPitch = -15)
-        initial_view = bullet.readUserDebugParameter(debug_initial_view)
-    if bullet.readUserDebugParameter(debug_front_view) != front_view:
-        # set the camera to be front view
-        bullet.resetDebugVisualizerCamera(
-            physicsClientId = physics_server_id,
-            cameraTargetPosition = [0, 0, 0.4],
-            cameraDistance = 1.5,
-            cameraYaw = 90,
-            cameraPitch = 0)
-        front_view = bullet.readUserDebugParameter(debug_front_view)
-    if bullet.readUserDebugParameter(debug_top_view) != top_view:
-        # set the camera to be overlook view
-        bullet.resetDebugVisualizerCamera(
-            physicsClientId = physics_server_id,
-            cameraTargetPosition = [0, 0, 0.4],
-            cameraDistance = 1.5,
-            cameraYaw = 90,
-            cameraPitch = -89)
-        top_view = bullet.readUserDebugParameter(debug_top_view)
-
-    if bullet.readUserDebugParameter(reset) != reset_value:
-        # reset position
-        bullet.resetBasePositionAndOrientation(a1.id, [0, 0, 0.43], [0, 0, 0, 1])
-        reset_value = bullet.readUserDebugParameter(reset)
+import logging
+from multiprocessing import Lock, Process
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter, sleep
+
+import numpy as np
+import pybullet as bullet
+from liba1 import A1
+
+logger = logging.getLogger(__name__)
+
+# The simulation is stepped explicitly at a fixed time step, DT, rather than in real time by the physics server
+DT = 1 / 240
+
+
+def solve_postures(inputs_name: str, targets_name: str, lock, reference_posture) -> None:
+    """
+    The worker process: solves the posture whenever the slider values change and publishes the motor targets
+
+    :param inputs_name : name of the shared memory holding the yaw, pitch, roll angles and Δz
+    :param targets_name: name of the shared memory holding the (4, 3) motor targets
+    :param lock        : guards both shared memories
+    """
+
+    # A spawned process does not inherit the logging configuration of the main process; under fork this is a no-op
+    logging.basicConfig(level=logging.INFO)
+
+    inputs_shm, targets_shm = SharedMemory(inputs_name), SharedMemory(targets_name)
+    inputs  = np.ndarray((4,), dtype=np.float64, buffer=inputs_shm.buf)
+    targets = np.ndarray((4, 3), dtype=np.float64, buffer=targets_shm.buf)
+
+    previous_inputs = None
+    while True:
+        start = perf_counter()
+        with lock:
+            current_inputs = tuple(inputs)
+        if current_inputs != previous_inputs:
+            posture = reference_posture.copy()
+            if A1.solve_posture(posture, *current_inputs):
+                with lock:
+                    targets[:] = posture
+            else:
+                logger.info('Motor limit reached')
+            previous_inputs = current_inputs
+        sleep(max(0, DT - (perf_counter() - start)))
+
+
+# The guard keeps the worker process from re-running the script when it is spawned rather than forked
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    # Initialisation
+    physics_server_id = bullet.connect(bullet.GUI)
+    bullet.setRealTimeSimulation(enableRealTimeSimulation=False, physicsClientId=physics_server_id)
+    bullet.setTimeStep(DT, physics_server_id)
+    bullet.setGravity(0, 0, -30, physics_server_id)
+    import pybullet_data; bullet.setAdditionalSearchPath(pybullet_data.getDataPath())
+    bullet.loadURDF("plane.urdf", physicsClientId=physics_server_id)
+    a1 = A1(physics_server_id)
+    bullet.resetDebugVisualizerCamera(
+        physicsClientId = physics_server_id,
+        cameraTargetPosition = [0, 0, 0.4],
+        cameraDistance = 1.5,
+        cameraYaw = 40,
+        cameraPitch = -15)
+
+    # Debug parameter silders to adjust the robot's motions
+    debug_roll_angle = bullet.addUserDebugParameter(
+        paramName = "roll angle (rad)",
+        rangeMin = -0.5,
+        rangeMax =  0.5,
+        startValue = 0,)
+    debug_pitch_angle = bullet.addUserDebugParameter(
+        paramName = "pitch angle (rad)",
+        rangeMin = -0.31,
+        rangeMax =  0.31,
+        startValue = 0,)
+    debug_yaw_angle = bullet.addUserDebugParameter(
+        paramName = "yaw angle (rad)",
+        rangeMin = -0.36,
+        rangeMax =  0.36,
+        startValue = 0,)
+    debug_height = bullet.addUserDebugParameter(
+        paramName = "Delta z",
+        rangeMin = -200,
+        rangeMax = 60,
+        startValue = 0,)
+
+    # Buttons to change the observing views
+    debug_initial_view = bullet.addUserDebugParameter(
+        paramName="initial view",
+        rangeMin = 1,
+        rangeMax = 0,
+        startValue = 0)
+    initial_view = bullet.readUserDebugParameter(debug_initial_view)
+    debug_front_view = bullet.addUserDebugParameter(
+        paramName="front view",
+        rangeMin = 1,
+        rangeMax = 0,
+        startValue = 0)
+    front_view = bullet.readUserDebugParameter(debug_front_view)
+    debug_top_view = bullet.addUserDebugParameter(
+        paramName="top view",
+        rangeMin = 1,
+        rangeMax = 0,
+        startValue = 0)
+    top_view = bullet.readUserDebugParameter(debug_top_view)
+
+    # Button to reset the robot position
+    reset = bullet.addUserDebugParameter(
+        paramName="Reset Position",
+        rangeMin = 1,
+        rangeMax = 0,
+        startValue = 0)
+    reset_value  = bullet.readUserDebugParameter(reset)
+
+    # Simulate one second to ensure that the motors reach their initial position before reading the position values.
+    for _ in range(round(1 / DT)):
+        bullet.stepSimulation(physics_server_id)
+    ini_posture = a1.current_posture()
+
+    # The postures are solved in a worker process. The latest slider values are passed in through shared memory, and
+    # the motor targets come back the same way.
+    inputs_shm  = SharedMemory(create=True, size=4 * np.dtype(np.float64).itemsize)
+    targets_shm = SharedMemory(create=True, size=ini_posture.nbytes)
+    inputs  = np.ndarray((4,), dtype=np.float64, buffer=inputs_shm.buf)     # yaw, pitch, roll angles and Δz
+    targets = np.ndarray((4, 3), dtype=np.float64, buffer=targets_shm.buf)  # a row of motor targets per leg
+    inputs[:]  = 0
+    targets[:] = ini_posture
+    lock = Lock()
+    worker = Process(target=solve_postures, args=(inputs_shm.name, targets_shm.name, lock, ini_posture), daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            start = perf_counter()
+            # The targets would never change again without the worker
+            if not worker.is_alive():
+                raise RuntimeError(f'The posture solving process exited with code {worker.exitcode}')
+
+            # Each debug parameter is read once per iteration
+            initial_view_value = bullet.readUserDebugParameter(debug_initial_view)
+            front_view_value   = bullet.readUserDebugParameter(debug_front_view)
+            top_view_value     = bullet.readUserDebugParameter(debug_top_view)
+            reset_button_value = bullet.readUserDebugParameter(reset)
+            slider_values = (bullet.readUserDebugParameter(debug_yaw_angle),
+                             bullet.readUserDebugParameter(debug_pitch_angle),
+                             bullet.readUserDebugParameter(debug_roll_angle),
+                             bullet.readUserDebugParameter(debug_height))
+
+            # The lock is only held for the copies, so the worker is not kept waiting on the physics server
+            with lock:
+                inputs[:] = slider_values
+                posture = targets.copy()
+            a1.set_posture(posture)
+
+            if initial_view_value != initial_view:
+                # set the camera to be initial view
+                bullet.resetDebugVisualizerCamera(
+                    physicsClientId = physics_server_id,
+                    cameraTargetPosition = [0, 0, 0.4],
+                    cameraDistance = 1.5,
+                    cameraYaw = 40,
+                    cameraPitch = -15)
+                initial_view = initial_view_value
+            if front_view_value != front_view:
+                # set the camera to be front view
+                bullet.resetDebugVisualizerCamera(
+                    physicsClientId = physics_server_id,
+                    cameraTargetPosition = [0, 0, 0.4],
+                    cameraDistance = 1.5,
+                    cameraYaw = 90,
+                    cameraPitch = 0)
+                front_view = front_view_value
+            if top_view_value != top_view:
+                # set the camera to be overlook view
+                bullet.resetDebugVisualizerCamera(
+                    physicsClientId = physics_server_id,
+                    cameraTargetPosition = [0, 0, 0.4],
+                    cameraDistance = 1.5,
+                    cameraYaw = 90,
+                    cameraPitch = -89)
+                top_view = top_view_value
+
+            if reset_button_value != reset_value:
+                # reset position
+                bullet.resetBasePositionAndOrientation(a1.id, [0, 0, 0.43], [0, 0, 0, 1])
+                reset_value = reset_button_value
+
+            bullet.stepSimulation(physics_server_id)
+            sleep(max(0, DT - (perf_counter() - start)))
+    finally:
+        inputs_shm.close(); inputs_shm.unlink()
+        targets_shm.close(); targets_shm.unlink()
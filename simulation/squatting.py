@@ -1,10 +1,16 @@
+import logging
 import pybullet as bullet
 from liba1 import A1
-from time import sleep
+from time import perf_counter, sleep
+
+logging.basicConfig(level=logging.INFO)
 
 # Initialisation
 physics_server_id = bullet.connect(bullet.GUI)
-bullet.setRealTimeSimulation(enableRealTimeSimulation=True, physicsClientId=physics_server_id)
+# The simulation is stepped explicitly at a fixed time step, DT, rather than in real time by the physics server
+DT = 1 / 240
+bullet.setRealTimeSimulation(enableRealTimeSimulation=False, physicsClientId=physics_server_id)
+bullet.setTimeStep(DT, physics_server_id)
 bullet.setGravity(0, 0, -30, physics_server_id)
 import pybullet_data; bullet.setAdditionalSearchPath(pybullet_data.getDataPath())
 bullet.loadURDF("plane.urdf", physicsClientId=physics_server_id)
@@ -22,8 +28,12 @@ debug_height = bullet.addUserDebugParameter(
     rangeMax = 60,
     startValue = 0,)
 
-sleep(1)  # Ugly so FIXME
-# The initialisation is asynchronous. Wait one second to ensure that the motors reach their initial position before reading the position values.
+# Simulate one second to ensure that the motors reach their initial position before reading the position values.
+for _ in range(round(1 / DT)):
+    bullet.stepSimulation(physics_server_id)
 ini_posture = a1.current_posture()
 while True:
+    start = perf_counter()
     a1.postural_control(Δz=bullet.readUserDebugParameter(debug_height), reference_posture=ini_posture)
+    bullet.stepSimulation(physics_server_id)
+    sleep(max(0, DT - (perf_counter() - start)))